@@ -3,6 +3,7 @@ import json
 import requests
 import os
 import random
+from collections import OrderedDict
 from geopy.distance import great_circle
 
 def calculate_radius(curr_min_rtt, prev_min_rtt):
@@ -121,163 +122,247 @@ def find_nearest_points(country1_code, country2_code, sample_size=100):
     else:
         return None, None, None, None
 
-def process_traceroute_file(traceroute_file_path):
+def parse_traceroute_line(line):
+    # Remove non-numeric leading characters
+    line = line.lstrip(' ╭─╰─')
+    # Skip lines with special characters or non-standard entries (including -inf RTTs)
+    if any(ch in line for ch in ['✓', '✘', '*', 'inf', 'S&T']):
+        return None
+
+    parts = line.strip().split()
+    if len(parts) < 4 or not parts[2].replace('.', '', 1).isdigit():
+        return None
+
+    ip_address, asn, rtt = parts[0], parts[1], float(parts[2])
+    geolocation = ' '.join(parts[3:]).strip('()')
+    return ip_address, asn, rtt, geolocation
+
+def resolve_hop_location(geolocation):
+    # Returns (latitude, longitude, uses_fallback); a None latitude means the lookup
+    # failed. Returns None if the hop is skipped without touching the floor-test state.
+    geolocation_parts = geolocation.rsplit(', ', 3)
+
+    if len(geolocation_parts) < 4 or 'None' in geolocation_parts[:2]:
+        # City or region is None, fall back to the nearest border point of the country
+        if len(geolocation_parts) < 4:
+            country1 = None
+        else:
+            country1 = geolocation_parts[2].strip()
+        country2 = "SG"  # Default to Singapore as the fallback (or adjust as needed)
+        if not country1 or len(country1) != 2:
+            print(f"Invalid country code detected: {country1}")
+            return None
+        latitude, longitude, _, _ = find_nearest_points(country1, country2)
+        return latitude, longitude, True
+
+    city, region, country, continent = geolocation_parts
+    latitude, longitude = geolocate_city_region(city, region, country.strip())
+    return latitude, longitude, False
+
+def floor_test_row(prev_point, data_point):
+    _, prev_latitude, prev_longitude, prev_min_rtt = prev_point
+    ip_address, latitude, longitude, rtt = data_point
+
+    radius = calculate_radius(rtt, prev_min_rtt) if prev_min_rtt is not None else None
+    within_radius = is_within_radius(prev_latitude, prev_longitude, latitude, longitude, radius) if radius is not None else True
+
+    return {
+        'ip_address': ip_address,
+        'rtt': rtt,
+        'radius': radius,
+        'geolocation_within_radius': within_radius
+    }
+
+def floor_test_hop(state, data_point, uses_fallback):
+    # state is (first_valid_row, anchor, first_point, last_point), where the anchor is the
+    # first valid row after the start of the trace or a failed lookup, and data points are
+    # (ip_address, latitude, longitude, rtt). data_point is None for a failed lookup.
+    # Returns (new_state, floor_test_result) where the result compares the hop against the
+    # previous valid data point; the first valid data point is tested against the final
+    # anchor once the whole trace has been read.
+    first_valid_row, anchor, first_point, last_point = state
+
+    if data_point is None:
+        return (True, anchor, first_point, last_point), None
+
+    if first_valid_row and not uses_fallback:
+        # The anchor row is not a data point of its own unless it came from the fallback
+        return (False, data_point, first_point, last_point), None
+
+    floor_test_result = floor_test_row(last_point, data_point) if last_point is not None else None
+    if first_valid_row:
+        anchor = data_point
+    if first_point is None:
+        first_point = data_point
+    return (False, anchor, first_point, data_point), floor_test_result
+
+def probe_id_from_path(traceroute_file_path):
+    # Trace files are named <anchor>-<probe>; traces from one probe share their opening hops
+    name = os.path.splitext(os.path.basename(traceroute_file_path))[0]
+    parts = name.split('-')
+    return parts[1] if len(parts) == 2 else name
+
+class LocationNode:
+    __slots__ = ('children', 'location')
+
+    def __init__(self, location=None):
+        self.children = {}
+        self.location = location
+
+class HopNode:
+    __slots__ = ('children', 'state', 'floor_test_result')
+
+    def __init__(self, state=None, floor_test_result=None):
+        self.children = {}
+        self.state = state
+        self.floor_test_result = floor_test_result
+
+class HopPrefixCache:
+    """Per-probe tries of hop sequences from traceroute files.
+
+    Each probe has two tries walked side by side. The location trie is keyed on
+    (IP, location) and holds the resolved coordinates, so geolocation lookups are only
+    made for the part of a path that diverges from earlier traces, whatever the RTTs.
+    The hop trie is keyed on (IP, location, RTT bucket) and holds the floor-test state
+    after each hop. rtt_bucket_ms=0 keys on the exact RTT and gives the same results as
+    an uncached run; a wider bucket reuses the first trace's RTTs within the bucket.
+    Failed lookups are never cached, and once max_nodes is reached the least recently
+    used probe tries are dropped.
+    """
+
+    def __init__(self, max_nodes=100000, rtt_bucket_ms=0):
+        self.max_nodes = max_nodes
+        self.rtt_bucket_ms = rtt_bucket_ms
+        self.tries = OrderedDict()
+        self.node_counts = {}
+        self.stats = {
+            'traces': 0,
+            'hops': 0,
+            'reused_hops': 0,
+            'lookups': 0,
+            'saved_lookups': 0,
+            'evicted_probes': 0
+        }
+
+    def __len__(self):
+        return sum(self.node_counts.values())
+
+    def roots(self, probe_id):
+        if probe_id not in self.tries:
+            self.tries[probe_id] = (LocationNode(), HopNode())
+            self.node_counts[probe_id] = 0
+        self.tries.move_to_end(probe_id)
+        self.stats['traces'] += 1
+        return self.tries[probe_id]
+
+    def hop_key(self, ip_address, geolocation, rtt):
+        if self.rtt_bucket_ms:
+            rtt = math.floor(rtt / self.rtt_bucket_ms)
+        return ip_address, geolocation, rtt
+
+    def add_child(self, probe_id, parent, key, node):
+        # Returns False without caching the node if the trie cannot grow
+        while len(self) >= self.max_nodes and len(self.tries) > 1:
+            evicted_probe = next(iter(self.tries))
+            if evicted_probe == probe_id:
+                self.tries.move_to_end(evicted_probe)
+                continue
+            del self.tries[evicted_probe]
+            del self.node_counts[evicted_probe]
+            self.stats['evicted_probes'] += 1
+        if len(self) >= self.max_nodes:
+            return False
+        parent.children[key] = node
+        self.node_counts[probe_id] += 1
+        return True
+
+    def summary(self):
+        stats = self.stats
+        return (f"Prefix cache: {stats['reused_hops']}/{stats['hops']} hops reused, "
+                f"{stats['saved_lookups']} geolocation lookups saved "
+                f"({stats['lookups']} made), {len(self)} nodes across {len(self.tries)} probes, "
+                f"{stats['evicted_probes']} probes evicted")
+
+hop_prefix_cache = HopPrefixCache()
+
+def process_traceroute_file(traceroute_file_path, prefix_cache=None):
+    if prefix_cache is None:
+        prefix_cache = hop_prefix_cache
+
     floor_test_results = []
-    valid_data_points = []
     all_data_points = []
 
-    prev_latitude, prev_longitude, prev_min_rtt = None, None, None
-    first_valid_row = True
-
     with open(traceroute_file_path, "r") as file:
         lines = file.readlines()
 
-    for line in lines:
-        # Remove non-numeric leading characters
-        line = line.lstrip(' ╭─╰─')  
-        # Skip lines with special characters or non-standard entries
-        if any(ch in line for ch in ['✓', '✘', '*', 'inf', 'S&T']):
-            continue
+    probe_id = probe_id_from_path(traceroute_file_path)
+    location_node, node = prefix_cache.roots(probe_id)
+    state = (True, None, None, None)
 
-        parts = line.strip().split()
-        if len(parts) < 4 or not parts[2].replace('.', '', 1).isdigit():
+    for line in lines:
+        hop = parse_traceroute_line(line)
+        if hop is None:
             continue
 
-        ip_address, asn, rtt = parts[0], parts[1], parts[2]
-        rtt = float(rtt) if rtt != '-inf' else None
-        geolocation = ' '.join(parts[3:]).strip('()')
-        geolocation_parts = geolocation.rsplit(', ', 3)
-
+        ip_address, asn, rtt, geolocation = hop
         all_data_points.append({
             'ip_address': ip_address,
             'asn': asn,
             'rtt': rtt,
             'geolocation': geolocation
         })
+        prefix_cache.stats['hops'] += 1
 
-        if rtt is None:
-            first_valid_row = True  # Reset for the next valid row
-            continue  # Skip if RTT is invalid
-
-        if len(geolocation_parts) < 4 or 'None' in geolocation_parts[:2]:
-            # Skip if city or region is None
-            if len(geolocation_parts) < 4:
-                country1 = None
-            else:
-                country1 = geolocation_parts[2].strip()
-            country2 = "SG"  # Default to Singapore as the fallback (or adjust as needed)
-            if not country1 or len(country1) != 2:
-                print(f"Invalid country code detected: {country1}")
-                continue
-            latitude, longitude, _, _ = find_nearest_points(country1, country2)
-            if latitude is None or longitude is None:
-                first_valid_row = True  # Reset for the next valid row
-                continue  # Skip if nearest points calculation fails
-
-            valid_data_points.append({
-                'ip_address': ip_address,
-                'rtt': rtt,
-                'latitude': latitude,
-                'longitude': longitude
-            })
-            if first_valid_row:
-                prev_latitude, prev_longitude, prev_min_rtt = latitude, longitude, rtt
-                first_valid_row = False
-            continue
-
-        city, region, country, continent = geolocation_parts
-        if city == 'None' or region == 'None':
-            # Skip if city or region is None
-            country1 = country.strip()
-            country2 = "SG"  # Default to Singapore as the fallback (or adjust as needed)
-            if not country1 or len(country1) != 2:
-                print(f"Invalid country code detected: {country1}")
-                continue
-            latitude, longitude, _, _ = find_nearest_points(country1, country2)
-            if latitude is None or longitude is None:
-                first_valid_row = True  # Reset for the next valid row
-                continue  # Skip if nearest points calculation fails
-
-            valid_data_points.append({
-                'ip_address': ip_address,
-                'rtt': rtt,
-                'latitude': latitude,
-                'longitude': longitude
-            })
-            if first_valid_row:
-                prev_latitude, prev_longitude, prev_min_rtt = latitude, longitude, rtt
-                first_valid_row = False
-            continue
+        # Once the trace leaves the cached prefix (or a lookup fails) both nodes are None
+        location_key = (ip_address, geolocation)
+        location_child = location_node.children.get(location_key) if location_node is not None else None
+        if location_child is not None:
+            lookups_stat = 'saved_lookups'
         else:
-            latitude, longitude = geolocate_city_region(city, region, country.strip())
-            if latitude is None or longitude is None:
-                first_valid_row = True  # Reset for the next valid row
-                continue  # Skip if geolocation lookup fails
-
-        if first_valid_row:
-            prev_latitude, prev_longitude, prev_min_rtt = latitude, longitude, rtt
-            first_valid_row = False
+            location_child = LocationNode(resolve_hop_location(geolocation))
+            lookups_stat = 'lookups'
+        location = location_child.location
+        if location is not None:
+            prefix_cache.stats[lookups_stat] += 2 if location[2] else 1
+
+        if location is not None and (location[0] is None or location[1] is None):
+            # Don't cache a failed lookup or anything downstream of it, so it is retried
+            location_node, node = None, None
+            state, _ = floor_test_hop(state, None, location[2])
             continue
 
-        city, region, country, continent = geolocation_parts
-        if city == 'None' or region == 'None':
-            # Skip if city or region is None
-            country1 = country.strip()
-            country2 = "SG"  # Default to Singapore as the fallback (or adjust as needed)
-            if not country1 or len(country1) != 2:
-                print(f"Invalid country code detected: {country1}")
-                continue
-            latitude, longitude, _, _ = find_nearest_points(country1, country2)
-            if latitude is None or longitude is None:
-                first_valid_row = True  # Reset for the next valid row
-                continue  # Skip if nearest points calculation fails
-
-            valid_data_points.append({
-                'ip_address': ip_address,
-                'rtt': rtt,
-                'latitude': latitude,
-                'longitude': longitude
-            })
-            if first_valid_row:
-                prev_latitude, prev_longitude, prev_min_rtt = latitude, longitude, rtt
-                first_valid_row = False
-            continue
+        if location_node is not None and location_key not in location_node.children:
+            if not prefix_cache.add_child(probe_id, location_node, location_key, location_child):
+                location_node, node = None, None
+
+        key = prefix_cache.hop_key(ip_address, geolocation, rtt)
+        child = node.children.get(key) if node is not None else None
+        if child is not None:
+            prefix_cache.stats['reused_hops'] += 1
         else:
-            latitude, longitude = geolocate_city_region(city, region, country.strip())
-            if latitude is None or longitude is None:
-                first_valid_row = True  # Reset for the next valid row
-                continue  # Skip if geolocation lookup fails
+            if location is None:
+                child = HopNode(state)
+            else:
+                latitude, longitude, uses_fallback = location
+                data_point = (ip_address, latitude, longitude, rtt)
+                child = HopNode(*floor_test_hop(state, data_point, uses_fallback))
+            if node is not None and not prefix_cache.add_child(probe_id, node, key, child):
+                location_node, node = None, None
 
-        valid_data_points.append({
-            'ip_address': ip_address,
-            'rtt': rtt,
-            'latitude': latitude,
-            'longitude': longitude
-        })
+        if node is not None:
+            location_node, node = location_child, child
 
-    if not valid_data_points:
+        state = child.state
+        if child.floor_test_result is not None:
+            floor_test_results.append(dict(child.floor_test_result))
+
+    first_valid_row, anchor, first_point, _ = state
+    if first_point is None:
         print("No valid data points found.")
         return
 
-    for data_point in valid_data_points:
-        latitude, longitude, rtt = data_point['latitude'], data_point['longitude'], data_point['rtt']
-        
-        if first_valid_row:
-            prev_latitude, prev_longitude, prev_min_rtt = latitude, longitude, rtt
-            first_valid_row = False
-            continue
-
-        radius = calculate_radius(rtt, prev_min_rtt) if prev_min_rtt is not None else None
-        within_radius = is_within_radius(prev_latitude, prev_longitude, latitude, longitude, radius) if radius is not None else True
-
-        floor_test_results.append({
-            'ip_address': data_point['ip_address'],
-            'rtt': rtt,
-            'radius': radius,
-            'geolocation_within_radius': within_radius
-        })
-
-        prev_latitude, prev_longitude, prev_min_rtt = latitude, longitude, rtt
+    if not first_valid_row:
+        floor_test_results.insert(0, floor_test_row(anchor, first_point))
 
     output_file_path = os.path.splitext(traceroute_file_path)[0] + "_floor_test_results.json"
     with open(output_file_path, "w") as file:
@@ -288,11 +373,25 @@ def process_traceroute_file(traceroute_file_path):
 
     print(f"Floor test results logged for {traceroute_file_path}.")
 
+def process_probe(trviz_directory, probe_id, prefix_cache=None):
+    if prefix_cache is None:
+        prefix_cache = hop_prefix_cache
+
+    # Process every trace from the probe so later traces reuse the shared prefixes
+    file_names = sorted(
+        file_name for file_name in os.listdir(trviz_directory)
+        if file_name.endswith(".txt") and probe_id_from_path(file_name) == probe_id
+    )
+    for file_name in file_names:
+        process_traceroute_file(os.path.join(trviz_directory, file_name), prefix_cache)
+
+    return len(file_names)
+
 def main():
     trviz_directory = "../trviz"  # Update the relative path to the "triviz" directory
     
     while True:
-        file_name = input("Enter the traceroute data file name (or 'q' to quit): ")
+        file_name = input("Enter the traceroute data file name or probe ID (or 'q' to quit): ")
         
         if file_name.lower() == 'q':
             break
@@ -301,6 +400,9 @@ def main():
         
         if os.path.isfile(traceroute_file_path):
             process_traceroute_file(traceroute_file_path)
+            print(hop_prefix_cache.summary())
+        elif file_name.isdigit() and process_probe(trviz_directory, file_name):
+            print(hop_prefix_cache.summary())
         else:
             print(f"File '{file_name}' not found in the 'triviz' directory.")
 
@@ -0,0 +1,232 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.floor_test import (
+    HopPrefixCache,
+    calculate_radius,
+    probe_id_from_path,
+    process_probe,
+    process_traceroute_file,
+)
+
+SHARED_HOPS = [
+    "   5.20.2.255      21412   0.0                     (Vilnius, Vilnius, LT, EU) dmz-2-255.cgates.lt\n",
+    "   5.20.2.254      21412   0.405                   (Vilnius, Vilnius, LT, EU) dmz-2-254.cgates.lt\n",
+    "╭─ 87.245.242.136  9002    14.715                  (Vilnius, Vilnius, LT, EU) ae0-202.rt.tic.vno.lt.retn.net\n",
+    "S (9002)  \n",
+]
+
+LOCATIONS = {
+    'Vilnius': (54.69, 25.28),
+    'Kaunas': (54.90, 23.89),
+    'Riga': (56.95, 24.11),
+    'Stockholm': (59.33, 18.07),
+    'Helsinki': (60.17, 24.94),
+}
+
+def hop_line(ip_address, rtt, location):
+    return f"   {ip_address:<15} 1234    {rtt:<10} ({location}) host.example.net\n"
+
+def city_lookup(city, region, country):
+    return LOCATIONS[city]
+
+class TestHopPrefixCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_trace(self, file_name, lines):
+        path = os.path.join(self.directory, file_name)
+        with open(path, "w") as file:
+            file.writelines(lines)
+        return path
+
+    def read_results(self, path):
+        with open(os.path.splitext(path)[0] + "_floor_test_results.json") as file:
+            return json.load(file)
+
+    def test_probe_id_from_path(self):
+        self.assertEqual(probe_id_from_path("../trviz/6049-6245.txt"), "6245")
+        self.assertEqual(probe_id_from_path("trace.txt"), "trace")
+
+    @patch('src.floor_test.geolocate_city_region')
+    def test_shared_prefix_is_resolved_once(self, mock_geolocate):
+        mock_geolocate.side_effect = city_lookup
+        first = self.write_trace("6049-6245.txt", SHARED_HOPS + [
+            "   194.68.123.73   8674    13.122              (Stockholm, Stockholm, SE, EU) vl215.ro1-stc.sth.netnod.se\n",
+        ])
+        second = self.write_trace("6053-6245.txt", SHARED_HOPS + [
+            "   195.13.160.1    8285    9.5                          (Riga, Riga, LV, EU) riga.example.net\n",
+        ])
+
+        cache = HopPrefixCache()
+        process_traceroute_file(first, cache)
+        self.assertEqual(mock_geolocate.call_count, 4)
+        process_traceroute_file(second, cache)
+        self.assertEqual(mock_geolocate.call_count, 5)
+
+        self.assertEqual(cache.stats['hops'], 8)
+        self.assertEqual(cache.stats['reused_hops'], 3)
+        self.assertEqual(cache.stats['saved_lookups'], 3)
+        self.assertEqual(len(cache), 10)
+
+        # The reused prefix gives the same results as an uncached run
+        cached_results = self.read_results(second)
+        process_traceroute_file(second, HopPrefixCache())
+        self.assertEqual(cached_results, self.read_results(second))
+        self.assertEqual(len(cached_results['floor_test_results']), 3)
+
+    @patch('src.floor_test.geolocate_city_region', return_value=(54.69, 25.28))
+    def test_rtt_bucket_shares_close_rtts(self, mock_geolocate):
+        jittered_hops = [line.replace("0.405", "0.412") for line in SHARED_HOPS]
+        first = self.write_trace("6049-6245.txt", SHARED_HOPS)
+        second = self.write_trace("6053-6245.txt", jittered_hops)
+
+        exact_cache = HopPrefixCache()
+        process_traceroute_file(first, exact_cache)
+        process_traceroute_file(second, exact_cache)
+        self.assertEqual(exact_cache.stats['reused_hops'], 1)
+        self.assertEqual(exact_cache.stats['saved_lookups'], 3)
+
+        bucket_cache = HopPrefixCache(rtt_bucket_ms=1)
+        process_traceroute_file(first, bucket_cache)
+        process_traceroute_file(second, bucket_cache)
+        self.assertEqual(bucket_cache.stats['reused_hops'], 3)
+
+    @patch('src.floor_test.geolocate_city_region', return_value=(54.69, 25.28))
+    def test_cache_is_bounded(self, mock_geolocate):
+        cache = HopPrefixCache(max_nodes=4)
+        process_traceroute_file(self.write_trace("6049-6245.txt", SHARED_HOPS), cache)
+        process_traceroute_file(self.write_trace("6049-6248.txt", SHARED_HOPS), cache)
+
+        self.assertEqual(cache.stats['evicted_probes'], 1)
+        self.assertEqual(list(cache.tries), ['6248'])
+        self.assertLessEqual(len(cache), 4)
+
+
+    @patch('src.floor_test.geolocate_city_region', side_effect=city_lookup)
+    def test_lookups_scale_with_divergent_suffix(self, mock_geolocate):
+        prefix = [
+            ("10.0.0.1", 0.0, "Vilnius, Vilnius, LT, EU"),
+            ("10.0.0.2", 0.4, "Vilnius, Vilnius, LT, EU"),
+            ("10.0.0.3", 3.1, "Kaunas, Kaunas, LT, EU"),
+            ("10.0.0.4", 7.8, "Riga, Riga, LV, EU"),
+        ]
+        suffixes = [
+            [("10.1.0.1", 15.2, "Stockholm, Stockholm, SE, EU")],
+            [("10.2.0.1", 12.4, "Helsinki, Uusimaa, FI, EU"), ("10.2.0.2", 12.9, "Helsinki, Uusimaa, FI, EU")],
+            [("10.3.0.1", 16.0, "Stockholm, Stockholm, SE, EU"), ("10.3.0.2", 18.3, "Vilnius, Vilnius, LT, EU")],
+        ]
+
+        cache = HopPrefixCache()
+        for index, suffix in enumerate(suffixes):
+            # Every trace sees slightly different RTTs on the shared prefix
+            lines = [hop_line(ip_address, round(rtt + 0.037 * index, 3), location)
+                     for ip_address, rtt, location in prefix + suffix]
+            lookups = mock_geolocate.call_count
+            path = self.write_trace(f"{6049 + index}-6245.txt", lines)
+            process_traceroute_file(path, cache)
+
+            expected_lookups = len(prefix) + len(suffix) if index == 0 else len(suffix)
+            self.assertEqual(mock_geolocate.call_count - lookups, expected_lookups)
+
+            cached_results = self.read_results(path)
+            process_traceroute_file(path, HopPrefixCache())
+            self.assertEqual(cached_results, self.read_results(path))
+
+        self.assertEqual(cache.stats['saved_lookups'], 2 * len(prefix))
+
+    @patch('src.floor_test.geolocate_city_region')
+    def test_failed_lookup_is_retried(self, mock_geolocate):
+        failures = ['Stockholm']
+        def flaky_lookup(city, region, country):
+            if city in failures:
+                failures.remove(city)
+                return None, None
+            return city_lookup(city, region, country)
+        mock_geolocate.side_effect = flaky_lookup
+        path = self.write_trace("6049-6245.txt", SHARED_HOPS + [
+            "   194.68.123.73   8674    13.122              (Stockholm, Stockholm, SE, EU) vl215.ro1-stc.sth.netnod.se\n",
+        ])
+
+        cache = HopPrefixCache()
+        process_traceroute_file(path, cache)
+        self.assertEqual(len(self.read_results(path)['floor_test_results']), 1)
+        self.assertEqual(len(cache), 6)
+
+        process_traceroute_file(path, cache)
+        self.assertEqual(mock_geolocate.call_count, 5)
+        cached_results = self.read_results(path)
+        self.assertEqual(len(cached_results['floor_test_results']), 3)
+        self.assertEqual(cached_results['floor_test_results'][-1]['ip_address'], "194.68.123.73")
+
+        process_traceroute_file(path, HopPrefixCache())
+        self.assertEqual(cached_results, self.read_results(path))
+
+    @patch('src.floor_test.geolocate_city_region', side_effect=city_lookup)
+    def test_failed_lookup_resets_anchor(self, mock_geolocate):
+        lines = [
+            hop_line("10.0.0.1", 0.0, "Vilnius, Vilnius, LT, EU"),
+            hop_line("10.0.0.2", 0.4, "Kaunas, Kaunas, LT, EU"),
+            hop_line("10.0.0.3", 3.1, "Atlantis, Atlantis, XX, EU"),
+            hop_line("10.0.0.4", 7.8, "Riga, Riga, LV, EU"),
+            hop_line("10.0.0.5", 15.2, "Stockholm, Stockholm, SE, EU"),
+        ]
+        path = self.write_trace("6049-6245.txt", lines)
+        mock_geolocate.side_effect = lambda city, region, country: (
+            (None, None) if city == 'Atlantis' else city_lookup(city, region, country))
+
+        cache = HopPrefixCache()
+        process_traceroute_file(path, cache)
+        results = self.read_results(path)['floor_test_results']
+
+        # The hop after the failure becomes the anchor the first data point is tested against
+        self.assertEqual([row['ip_address'] for row in results], ["10.0.0.2", "10.0.0.5"])
+        self.assertAlmostEqual(results[0]['radius'], calculate_radius(0.4, 7.8))
+        self.assertAlmostEqual(results[1]['radius'], calculate_radius(15.2, 0.4))
+        self.assertEqual(len(cache), 4)
+
+    @patch('src.floor_test.find_nearest_points', return_value=(-26.2, 28.0, 1.3, 103.8))
+    @patch('src.floor_test.geolocate_city_region', return_value=(-26.2, 28.05))
+    def test_fallback_first_hop(self, mock_geolocate, mock_nearest_points):
+        lines = [
+            hop_line("197.80.104.36", 0.0, "None, None, ZA, AF"),
+            hop_line("197.80.75.3", 2.062, "Randburg, Gauteng, ZA, AF"),
+        ]
+        path = self.write_trace("6501-6053.txt", lines)
+
+        cache = HopPrefixCache()
+        process_traceroute_file(path, cache)
+        process_traceroute_file(path, cache)
+        results = self.read_results(path)['floor_test_results']
+
+        # A fallback anchor is also a data point, so it is first tested against itself
+        self.assertEqual([row['ip_address'] for row in results], ["197.80.104.36", "197.80.75.3"])
+        self.assertEqual(results[0]['radius'], 0.0)
+        self.assertTrue(results[0]['geolocation_within_radius'])
+        mock_nearest_points.assert_called_once_with("ZA", "SG")
+        self.assertEqual(cache.stats['saved_lookups'], 3)
+
+    @patch('src.floor_test.geolocate_city_region', side_effect=city_lookup)
+    def test_process_probe(self, mock_geolocate):
+        self.write_trace("6049-6245.txt", SHARED_HOPS)
+        self.write_trace("6053-6245.txt", SHARED_HOPS)
+        other = self.write_trace("6049-6248.txt", SHARED_HOPS)
+
+        cache = HopPrefixCache()
+        self.assertEqual(process_probe(self.directory, "6245", cache), 2)
+        self.assertEqual(process_probe(self.directory, "9999", cache), 0)
+
+        self.assertFalse(os.path.exists(os.path.splitext(other)[0] + "_floor_test_results.json"))
+        self.assertEqual(mock_geolocate.call_count, 3)
+        self.assertEqual(cache.summary(),
+                         "Prefix cache: 3/6 hops reused, 3 geolocation lookups saved (3 made), "
+                         "6 nodes across 1 probes, 0 probes evicted")
+
+
+if __name__ == '__main__':
+    unittest.main()